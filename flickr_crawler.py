@@ -2,139 +2,638 @@
 # -*- coding: UTF-8 -*-
 
 import argparse
-import flickrapi
-import json
+import asyncio
+import httpx
+import orjson
 import os
 import os.path
-import urllib
+import re
+import shutil
+import sqlite3
+import time
 
-from collections    import namedtuple
+from collections         import deque, namedtuple
+from concurrent.futures  import ThreadPoolExecutor
 
 # Fetches public images using the Flickr API.
-
-# Which picture to download. Medium 640 is max. 640 x 640 pixels.
-SOURCE_SIZE = "Medium 640"
+#
+# Requires httpx with HTTP/2 support and orjson (see requirements.txt).
+
+# Which picture to download. Medium 640 ("url_z") is max. 640 x 640 pixels.
+SOURCE_URL_EXTRA = "url_z"
+
+# Extra meta-data returned with each search result, so that no additional API
+# call is required per photo.
+SEARCH_EXTRAS = ",".join([
+    SOURCE_URL_EXTRA, "owner_name", "path_alias", "tags", "machine_tags"
+])
+
+FLICKR_REST_URL = "https://api.flickr.com/services/rest/"
+
+# Flickr doesn't return more than 4000 results for a query: later pages repeat
+# earlier results. The search is walked backward through upload date windows,
+# which are sized so that each holds at most that many photos.
+MAX_RESULTS_PER_QUERY = 4000
+PHOTOS_PER_PAGE       = 100
+MAX_PAGES_PER_QUERY   = MAX_RESULTS_PER_QUERY // PHOTOS_PER_PAGE
+INITIAL_WINDOW        = 24 * 3600 # seconds
+MIN_WINDOW            = 60        # seconds
+
+# No photo has been uploaded on Flickr before 2004-01-01.
+FLICKR_EPOCH = 1072915200
+
+# Delay before retrying a failed search.
+SEARCH_RETRY_DELAY = 5 # seconds
+
+# Maximum number of simultaneous Flickr API calls and HTTP connections. Images
+# are downloaded from the CDN through a distinct HTTP/2 client so they never
+# delay API calls. HTTP/2 multiplexes the concurrent downloads over these few
+# connections.
+MAX_CONCURRENT_REQUESTS = 32
+MAX_CONNECTIONS         = 64
+MAX_CDN_CONNECTIONS     = 8
+
+# Flickr allows 3600 API calls per hour and per key.
+MAX_REQUESTS_PER_HOUR = 3600
+
+# Idle connections are kept open between two search pages so that the next
+# requests reuse them instead of doing new TCP and TLS handshakes. The request
+# timeout applies to each phase (connection, read, write) of a request.
+KEEPALIVE_TIMEOUT = 60 # seconds
+REQUEST_TIMEOUT   = 30 # seconds
+
+# Images are streamed to their file by chunks of this size.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Photos are written in this hidden directory of the destination directory and
+# only moved next to the other photos once complete. Files left by an
+# interrupted run are removed at startup.
+PARTIAL_DIR = ".partial"
+
+# Written images are evicted from the page cache once the kernel has written
+# them back to the disk, which Linux does for pages dirty for more than 30
+# seconds (vm.dirty_expire_centisecs).
+EVICTION_DELAY = 60 # seconds
+
+# Maximum number of photos being downloaded at once. Search pages keep being
+# requested while the photos of the previous pages are downloaded.
+MAX_DOWNLOADS = 100
+
+# When owners are resolved (--resolve-owners), they are saved in this file of
+# the destination directory and reused by the next runs.
+OWNERS_FILE = ".owners.json"
+
+# Index of the downloaded photo IDs, stored in the destination directory.
+# Insertions are committed by batches.
+IDS_FILE            = ".ids.db"
+IDS_COMMIT_INTERVAL = 1000
+
+# Tags made of other characters than ASCII letters and digits are ignored.
+VALID_TAG_REGEX = re.compile(r"[A-Za-z0-9]*")
 
 Photo = namedtuple("Photo", "id title owner tags url")
 Owner = namedtuple("Owner", "id username name")
 
-def photos_stream(ids, flickr, license):
+class FlickrAPI:
+    """Minimal asynchronous client for the Flickr REST API."""
+
+    def __init__(self, client, api_key):
+        self.client    = client
+        self.api_key   = api_key
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        # Times of the calls made during the last hour.
+        self.last_calls = deque()
+
+    async def throttle(self):
+        """Waits until a call can be made without exceeding the API quota."""
+
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self.last_calls and self.last_calls[0] <= now - 3600:
+                self.last_calls.popleft()
+
+            if len(self.last_calls) < MAX_REQUESTS_PER_HOUR:
+                self.last_calls.append(now)
+                return
+
+            await asyncio.sleep(self.last_calls[0] + 3600 - now)
+
+    async def call(self, method, **params):
+        """
+        Calls the API method and returns the parsed JSON response. Network
+        failures are reported as Flickr errors.
+        """
+
+        params.update(
+            method=method, api_key=self.api_key, format="json",
+            nojsoncallback=1
+        )
+
+        await self.throttle()
+
+        async with self.semaphore:
+            try:
+                resp = await self.client.get(FLICKR_REST_URL, params=params)
+                resp.raise_for_status()
+                return orjson.loads(resp.content)
+            except (httpx.HTTPError, ValueError):
+                return { "stat": "fail" }
+
+class OwnerCache:
     """
-    Returns an iteraror of Photo objects until the Flickr search is exhausted.
+    Resolves photo owners with flickr.people.getInfo, which provides their real
+    name. Each owner is only requested once, even when several photos ask for
+    it concurrently.
+
+    The cache file is replaced atomically when saved. An unreadable cache file
+    is ignored, and the owners are requested again.
     """
 
-    page = 1
-    prev_ids = set()
-    while True:
-        print ("Asking for page %d ..." % page)
+    def __init__(self, flickr, filepath):
+        self.flickr   = flickr
+        self.filepath = filepath
+        self.pending  = {}
+        self.owners   = {}
+
+        if os.path.isfile(filepath):
+            with open(filepath, "rb") as f:
+                content = f.read()
+
+            try:
+                self.owners = {
+                    owner_id: Owner(**owner)
+                    for owner_id, owner in orjson.loads(content).items()
+                }
+            except (ValueError, TypeError, AttributeError):
+                print("Invalid owners cache file (%s). Ignored." % filepath)
+
+    async def resolve(self, owner_id):
+        """Returns the Owner object, or None if Flickr failed to answer."""
 
-        photos = flickr.photos.search(
-            page=page, sort="relevance", license=license # CC Attribution License
+        if owner_id in self.owners:
+            return self.owners[owner_id]
+
+        if owner_id not in self.pending:
+            self.pending[owner_id] = asyncio.create_task(self.fetch(owner_id))
+
+        return await self.pending[owner_id]
+
+    async def fetch(self, owner_id):
+        info = await self.flickr.call("flickr.people.getInfo", user_id=owner_id)
+        del self.pending[owner_id]
+
+        if is_flickr_error(info):
+            print("Unable to fetch information for a user (%s)." % owner_id)
+            return None
+
+        person = info["person"]
+        owner = Owner(
+            owner_id, person.get("path_alias"),
+            person.get("realname", {}).get("_content")
         )
-        if is_flickr_error(photos):
-            print("Unable to fetch the search results. Retrying ...")
-            continue
+        self.owners[owner_id] = owner
+        return owner
+
+    def save(self):
+        """Writes the resolved owners into the cache file."""
+        tmp_filepath = self.filepath + ".tmp"
+        write_file(tmp_filepath, pretty_json({
+            owner_id: owner._asdict()
+            for owner_id, owner in self.owners.items()
+        }))
+        os.replace(tmp_filepath, self.filepath)
+
+class PageCacheEvictor:
+    """
+    Evicts written images from the page cache, as the crawler never reads them
+    back. Only clean pages can be evicted, so files are evicted by batches
+    EVICTION_DELAY after being written, once the kernel wrote them back,
+    instead of forcing a disk flush per file. Evictions run in a dedicated
+    thread. No-op on platforms without posix_fadvise().
+    """
+
+    def __init__(self):
+        self.enabled  = hasattr(os, "posix_fadvise")
+        self.written  = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def add(self, filepath):
+        """Schedules the eviction of the written file."""
 
-        this_ids = set(p["id"] for p in photos["photos"]["photo"])
-        if this_ids == prev_ids:
-            print("Flickr gave the same results as the previous request. Stop.")
+        if not self.enabled:
             return
-        prev_ids = this_ids
 
-        for p in photos["photos"]["photo"]:
-            # Fetches meta-data and source image for each result.
-            if p["id"] in ids:
-                print("File %s already exists. Skip." % p["id"])
-                continue
+        now = time.monotonic()
+        self.written.append((now, filepath))
+
+        batch = []
+        while self.written and self.written[0][0] <= now - EVICTION_DELAY:
+            batch.append(self.written.popleft()[1])
+
+        if batch:
+            self.executor.submit(evict_files, batch)
+
+    def close(self):
+        """Waits for the scheduled evictions to complete."""
+        self.executor.shutdown()
 
-            info = flickr.photos.getInfo(photo_id=p["id"], secret=p["secret"])
-            if is_flickr_error(info):
-                print(
-                    "Unable to fetch information for a picture (%s). Skip."
-                    % p["id"]
+class IdIndex:
+    """
+    Set of the IDs of the downloaded photos, backed by a SQLite database. The
+    database is initialized from the existing files when it doesn't exist.
+
+    Transactions are explicit, so that the table is created and filled
+    atomically: an interrupted initialization is restarted by the next run.
+
+    The index is not checked against the files afterwards: a photo whose files
+    are deleted is not downloaded again until the index is rebuilt with
+    `reindex`, which drops the table and fills it again from the files.
+
+    Queries and commits run in a dedicated thread, which owns the connection,
+    so that they never block the event loop.
+    """
+
+    def __init__(self, filepath, dest_dir, reindex=False):
+        self.executor      = ThreadPoolExecutor(max_workers=1)
+        self.n_uncommitted = 0
+
+        self.executor.submit(self.open, filepath, dest_dir, reindex).result()
+
+    def open(self, filepath, dest_dir, reindex):
+        self.conn = sqlite3.connect(filepath, isolation_level=None)
+
+        is_new = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ids'"
+        ).fetchone() is None
+
+        if is_new or reindex:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DROP TABLE IF EXISTS ids")
+                self.conn.execute(
+                    "CREATE TABLE ids (id TEXT PRIMARY KEY) WITHOUT ROWID"
+                )
+                self.conn.executemany(
+                    "INSERT INTO ids VALUES (?)",
+                    ((photo_id,) for photo_id in existing_files(dest_dir))
                 )
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                self.conn.close()
+                raise
+            self.conn.execute("COMMIT")
+
+    async def run(self, func):
+        """Runs the function in the thread of the connection."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func)
+
+    async def contains(self, photo_id):
+        def select():
+            cursor = self.conn.execute(
+                "SELECT 1 FROM ids WHERE id = ?", (photo_id,)
+            )
+            return cursor.fetchone() is not None
+
+        return await self.run(select)
+
+    async def count(self):
+        def select():
+            return self.conn.execute("SELECT COUNT(*) FROM ids").fetchone()[0]
+
+        return await self.run(select)
+
+    async def add(self, photo_id):
+        def insert():
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+
+            self.conn.execute(
+                "INSERT OR IGNORE INTO ids VALUES (?)", (photo_id,)
+            )
+
+            self.n_uncommitted += 1
+            if self.n_uncommitted >= IDS_COMMIT_INTERVAL:
+                self.conn.execute("COMMIT")
+                self.n_uncommitted = 0
+
+        await self.run(insert)
+
+    async def close(self):
+        """Commits the pending insertions and closes the database."""
+
+        def close():
+            if self.conn.in_transaction:
+                self.conn.execute("COMMIT")
+            self.conn.close()
+
+        await self.run(close)
+        self.executor.shutdown()
+
+async def photos_stream(ids, flickr, cdn, owners, evictor, dest_dir, license):
+    """
+    Returns an asynchronous iterator of Photo objects until the Flickr search
+    is exhausted. The search results already contain the meta-data of the
+    photos, whose images are concurrently downloaded from the CDN client into
+    the destination directory. Photos are yielded once their image and their
+    meta-data are written.
+    """
+
+    done = asyncio.Queue()
+    producer = asyncio.create_task(
+        start_downloads(
+            ids, flickr, cdn, owners, evictor, dest_dir, license, done
+        )
+    )
+
+    try:
+        while True:
+            photo = await done.get()
+            if photo is None:
+                break
+
+            yield photo
+
+        # Raises the exception of the producer, if any.
+        await producer
+    finally:
+        producer.cancel()
+
+async def start_downloads(ids, flickr, cdn, owners, evictor, dest_dir, license,
+                          done):
+    """
+    Starts the download of every new photo of the search, up to MAX_DOWNLOADS
+    at once. Puts the written photos in the queue, followed by None once the
+    search is exhausted.
+    """
+
+    slots     = asyncio.Semaphore(MAX_DOWNLOADS)
+    in_flight = {}
+
+    async def download(photo, source_url):
+        try:
+            written = await download_photo(
+                cdn, owners, evictor, photo, source_url, dest_dir
+            )
+            if written is not None:
+                done.put_nowait(written)
+        finally:
+            del in_flight[photo.id]
+            slots.release()
+
+    try:
+        async for p in search_results(flickr, license):
+            if p["id"] in in_flight or await ids.contains(p["id"]) \
+               or await asyncio.to_thread(is_downloaded, dest_dir, p["id"]):
+                print("File %s already exists. Skip." % p["id"])
                 continue
 
-            sizes = flickr.photos.getSizes(photo_id=p["id"])
-            if is_flickr_error(sizes):
-                print(
-                    "Unable to fetch information picture (%s) sources. Skip."
-                    % p["id"]
-                )
+            photo = parse_photo(p)
+            if photo is None:
                 continue
 
-            source = find(
-                lambda size: size["label"] == SOURCE_SIZE,
-                sizes["sizes"]["size"]
+            await slots.acquire()
+            in_flight[photo.id] = asyncio.create_task(
+                download(photo, p[SOURCE_URL_EXTRA])
             )
-            if source == None:
-                print(
-                    "The picture (%s) has no corresponding image. Skip."
-                    % p["id"]
+
+        await asyncio.gather(*in_flight.values())
+    finally:
+        for task in in_flight.values():
+            task.cancel()
+
+        done.put_nowait(None)
+
+async def search_results(flickr, license):
+    """
+    Returns an asynchronous iterator of the search results, walking backward
+    through upload date windows.
+    """
+
+    max_date = int(time.time())
+    window   = INITIAL_WINDOW
+    while max_date > FLICKR_EPOCH:
+        # Shrinks the window until Flickr is able to return all of its results.
+        window = min(window, max_date - FLICKR_EPOCH)
+        while True:
+            min_date = max_date - window
+            photos = await search_photos(flickr, license, min_date, max_date, 1)
+            total = int(photos["photos"]["total"])
+            if total <= MAX_RESULTS_PER_QUERY or window <= MIN_WINDOW:
+                break
+            window //= 2
+
+        if total > MAX_RESULTS_PER_QUERY:
+            print(
+                "Only %d of the %d photos uploaded from %s to %s can be "
+                "fetched." % (
+                    MAX_RESULTS_PER_QUERY, total, format_date(min_date),
+                    format_date(max_date)
                 )
-                continue
-            source_url = source["source"]
-            if source_url[-4:] != ".jpg" and source_url[-5:] != ".jpeg":
-                print("The picture (%s) is not a JPEG image. Skip." % p["id"])
-                continue
+            )
 
-            try:
-                jpg = download_url(source_url)
-            except:
-                print("Failed to download the picture (%s). Skip." % p["id"])
-                continue
+        n_pages = min(photos["photos"]["pages"], MAX_PAGES_PER_QUERY)
+
+        page = 1
+        while True:
+            for p in photos["photos"]["photo"]:
+                yield p
+
+            page += 1
+            if page > n_pages:
+                break
 
-            owner = Owner(
-                p["owner"], info["photo"]["owner"]["path_alias"],
-                info["photo"]["owner"]["realname"]
+            photos = await search_photos(
+                flickr, license, min_date, max_date, page
             )
 
-            tags = [ t["raw"].lower()
-                     for t in info["photo"]["tags"]["tag"]
-                     if not t["machine_tag"] and is_valid_tag(t["raw"]) ]
+        max_date = min_date
+        if total < MAX_RESULTS_PER_QUERY // 2:
+            window *= 2
 
-            url = "https://www.flickr.com/photos/{0}/{1}/".format(
-                owner.id, p["id"]
+async def search_photos(flickr, license, min_date, max_date, page):
+    """
+    Returns the search results page of the photos uploaded in the
+    [min_date, max_date[ interval. Retries until Flickr answers.
+    """
+
+    while True:
+        print(
+            "Asking for page %d of the photos uploaded from %s to %s ..." % (
+                page, format_date(min_date), format_date(max_date)
             )
+        )
 
-            yield (Photo(p["id"], p["title"], owner, tags, url), jpg)
+        photos = await flickr.call(
+            "flickr.photos.search",
+            min_upload_date=min_date, max_upload_date=max_date - 1,
+            sort="date-posted-desc", page=page, per_page=PHOTOS_PER_PAGE,
+            license=license,
+            extras=SEARCH_EXTRAS
+        )
+        if not is_flickr_error(photos):
+            return photos
 
-            ids.add(p["id"])
+        print("Unable to fetch the search results. Retrying ...")
+        await asyncio.sleep(SEARCH_RETRY_DELAY)
 
-        page += 1
-        if page >= photos["photos"]["pages"]:
-            return
+def parse_photo(p):
+    """
+    Returns the Photo object of a search result, or None if the picture has no
+    usable image.
+    """
+
+    source_url = p.get(SOURCE_URL_EXTRA)
+    if source_url is None:
+        print("The picture (%s) has no corresponding image. Skip." % p["id"])
+        return None
+    if not source_url.endswith((".jpg", ".jpeg")):
+        print("The picture (%s) is not a JPEG image. Skip." % p["id"])
+        return None
+
+    owner = Owner(p["owner"], p.get("pathalias"), p.get("ownername"))
+
+    # Machine tags (e.g. "geo:lat=...") are also listed in the tags.
+    machine_tags = set(p.get("machine_tags", "").split())
+    tags = [ t
+             for t in p.get("tags", "").split()
+             if t not in machine_tags and is_valid_tag(t) ]
+
+    url = "https://www.flickr.com/photos/{0}/{1}/".format(owner.id, p["id"])
+
+    return Photo(p["id"], p["title"], owner, tags, url)
+
+async def download_photo(cdn, owners, evictor, photo, source_url, dest_dir):
+    """
+    Downloads the image and writes the meta-data of the photo into the
+    destination directory. If an owner cache is given, the owner is resolved
+    while the image downloads. Returns the Photo object, or None if the photo
+    has not been written. Files are written from worker threads so that the
+    event loop never waits on the file system.
+    """
+
+    basename = os.path.join(dest_dir, photo.id)
+    partial  = os.path.join(dest_dir, PARTIAL_DIR, photo.id)
+
+    download = download_to(cdn, source_url, partial + ".jpg")
+
+    try:
+        if owners is None:
+            await download
+        else:
+            _, owner = await asyncio.gather(
+                download, owners.resolve(photo.owner.id)
+            )
+            if owner is not None:
+                photo = photo._replace(owner=owner)
+    except (httpx.HTTPError, OSError):
+        print("Failed to download the picture (%s). Skip." % photo.id)
+        return None
+
+    try:
+        await asyncio.to_thread(
+            finalize_photo, partial, basename, pretty_json(photo_to_dict(photo))
+        )
+    except OSError:
+        print("Unable to write the picture (%s). Skip." % photo.id)
+
+        await asyncio.to_thread(
+            remove_files, [partial + ".jpg", partial + ".json"]
+        )
+        return None
+
+    evictor.add(basename + ".jpg")
+
+    return photo
+
+def finalize_photo(partial, basename, json):
+    """
+    Writes the meta-data next to the partially downloaded image and moves both
+    files to their final name. The meta-data file is moved last, as it marks
+    the photo as downloaded.
+    """
+
+    write_file(partial + ".json", json)
+    os.replace(partial + ".jpg", basename + ".jpg")
+    os.replace(partial + ".json", basename + ".json")
+
+def remove_files(filepaths):
+    """Removes the files which exist."""
+    for filepath in filepaths:
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+def is_downloaded(dest_dir, photo_id):
+    """Returns True if the meta-data of the photo exist."""
+    return os.path.isfile(os.path.join(dest_dir, photo_id + ".json"))
+
+def format_date(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp))
 
 def is_flickr_error(resp):
     return resp["stat"] != "ok"
 
 def is_valid_tag(tag):
-    def is_ascii_alpha_num(c):
-        c_ord = ord(c)
-        return ord('A') <= c_ord <= ord('Z') or \
-               ord('a') <= c_ord <= ord('z') or \
-               ord('0') <= c_ord <= ord('9')
+    """Returns True if the tag only contains ASCII letters and digits."""
+    return VALID_TAG_REGEX.fullmatch(tag) is not None
 
-    return all(is_ascii_alpha_num(c) for c in tag)
+async def download_to(client, url, filepath):
+    """
+    Streams the URL content into the file. File operations run in worker
+    threads. The partially written file is removed if the download fails.
+    """
 
-def download_url(url):
-    """Returns the file content."""
-    return urllib.request.urlopen(url).read()
+    try:
+        async with client.stream("GET", url) as resp:
+            resp.raise_for_status()
 
-def write_file(filepath, content):
-    """Writes the buffer content into the file."""
+            f = await asyncio.to_thread(open, filepath, "wb")
+            try:
+                async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+    except BaseException:
+        await asyncio.to_thread(remove_files, [filepath])
+        raise
+
+def evict_files(filepaths):
+    """
+    Evicts the clean pages of the files from the page cache. Files which have
+    been removed since are ignored.
+    """
 
-    if type(content) == str:
-        flag = "w"
-    elif type(content) == bytes:
-        flag = "wb"
+    for filepath in filepaths:
+        try:
+            fd = os.open(filepath, os.O_RDONLY)
+        except OSError:
+            continue
+
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
 
-    with open(filepath, flag) as f:
+def write_file(filepath, content):
+    """Writes the bytes buffer content into the file."""
+    with open(filepath, "wb") as f:
         f.write(content)
 
+def photo_to_dict(photo):
+    """
+    Named-tuples are JSON encoded as array. Converts the photo and its owner to
+    dictionnaries before serializing.
+    """
+
+    photo_dict = photo._asdict()
+    photo_dict["owner"] = photo.owner._asdict()
+    return photo_dict
+
 def pretty_json(obj):
-    """Renders the object as a pretty JSON string."""
-    return json.dumps(obj, sort_keys=True, indent=4, separators=(',', ': '))
+    """Renders the object as a pretty UTF-8 encoded JSON string."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
 
 def get_cli_args_parser():
     parser = argparse.ArgumentParser(
@@ -149,7 +648,7 @@ def get_cli_args_parser():
 
     parser.add_argument(
         'api_secret', metavar='api_key', type=str,
-        help='Flickr API secret'
+        help='Flickr API secret (unused, public API calls are unsigned)'
     )
 
     parser.add_argument(
@@ -171,51 +670,99 @@ def get_cli_args_parser():
              """
     )
 
-    return parser
+    parser.add_argument(
+        "--resolve-owners", action="store_true",
+        help="""Fetches the real name of the owners with an additional API
+             call per owner. Otherwise, their Flickr screen name is used"""
+    )
 
-def find(pred, xs):
-    for x in xs:
-        if pred(x):
-            return x
+    parser.add_argument(
+        "--reindex", action="store_true",
+        help="""Rebuilds the index of the downloaded pictures from the files
+             of dest_dir. Pictures whose files have been deleted are only
+             downloaded again after a reindex"""
+    )
 
-    return None
+    return parser
 
 def existing_files(dest_dir):
-    """Returns the set of IDs of existing files."""
-    return set(os.path.splitext(f)[0] for f in os.listdir(dest_dir)
-               if os.path.isfile(os.path.join(dest_dir, f)))
+    """
+    Returns the set of IDs of the photos whose meta-data file exists. Hidden
+    files are ignored.
+    """
 
-if __name__ == "__main__":
-    cli_args   = get_cli_args_parser().parse_args()
+    with os.scandir(dest_dir) as entries:
+        return set(e.name.rpartition(".")[0] for e in entries
+                   if e.name.endswith(".json") and not e.name.startswith(".")
+                   and e.is_file(follow_symlinks=False))
+
+async def main(cli_args):
     api_key    = cli_args.api_key
-    api_secret = cli_args.api_secret
     dest_dir   = cli_args.dest_dir
     license    = cli_args.license
 
-    flickr = flickrapi.FlickrAPI(api_key, api_secret, format='parsed-json')
+    partial_dir = os.path.join(dest_dir, PARTIAL_DIR)
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
 
-    ids = existing_files(dest_dir)
-    n_existing = len(ids)
+    ids = IdIndex(
+        os.path.join(dest_dir, IDS_FILE), dest_dir, cli_args.reindex
+    )
+    n_existing = await ids.count()
     print ("%d pictures already downloaded." % n_existing)
 
-    for (p, jpg) in photos_stream(ids, flickr, license):
-        basename  = os.path.join(dest_dir, p.id)
-        jpg_file  = basename + ".jpg"
-        json_file = basename + ".json"
+    api_limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_TIMEOUT
+    )
+    cdn_limits = httpx.Limits(
+        max_connections=MAX_CDN_CONNECTIONS,
+        max_keepalive_connections=MAX_CDN_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_TIMEOUT
+    )
+    async with httpx.AsyncClient(limits=api_limits,
+                                 timeout=REQUEST_TIMEOUT) as api, \
+               httpx.AsyncClient(http2=True, limits=cdn_limits,
+                                 timeout=REQUEST_TIMEOUT) as cdn:
+        flickr = FlickrAPI(api, api_key)
+
+        if cli_args.resolve_owners:
+            owners = OwnerCache(flickr, os.path.join(dest_dir, OWNERS_FILE))
+        else:
+            owners = None
+
+        evictor = PageCacheEvictor()
+
+        try:
+            await download_photos(
+                ids, flickr, cdn, owners, evictor, dest_dir, license
+            )
+        finally:
+            evictor.close()
+            if owners is not None:
+                await asyncio.to_thread(owners.save)
 
-        if os.path.isfile(jpg_file) or os.path.isfile(json_file):
-            print("File %s already exists. Skip." % p.id)
-            continue
+            n_total = await ids.count()
+            await ids.close()
 
-        print("%s - %s" % (p.id, p.url))
+    n_downloaded = n_total - n_existing
+    print ("%d pictures downloaded, %d in total." % (n_downloaded, n_total))
 
-        # Named-tuples are JSON encoded as array. Converts the two named-tuples
-        # to dictionnaries before serializing.
-        p_dict = p.__dict__
-        p_dict["owner"] = p_dict["owner"].__dict__
+async def download_photos(ids, flickr, cdn, owners, evictor, dest_dir,
+                          license):
+    """
+    Downloads the image and writes the meta-data of every photo. Photos are
+    added to the index once both files have been written.
+    """
 
-        write_file(jpg_file, jpg)
-        write_file(json_file, pretty_json(p_dict))
+    stream = photos_stream(
+        ids, flickr, cdn, owners, evictor, dest_dir, license
+    )
+    async for p in stream:
+        print("%s - %s" % (p.id, p.url))
 
-    n_downloaded = len(ids) - n_existing
-    print ("%d pictures downloaded, %d in total." % (n_downloaded, len(ids)))
+        await ids.add(p.id)
+
+if __name__ == "__main__":
+    asyncio.run(main(get_cli_args_parser().parse_args()))